@@ -22,13 +22,20 @@ A bot to track APRS packet activity from the ISS.
 """
 
 # Imports
+import asyncio
+import io
 import logging
+import pickle
+from collections import defaultdict
 
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, PicklePersistence, filters, ContextTypes
+from telegram.error import RetryAfter
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ExtBot
 from ptbcontrib.ptb_jobstores.mongodb import PTBMongoDBJobStore
+from pymongo import ASCENDING
 
 import issaprs as iss
+import config
 from config import BOT_KEY, MONGO_DB_URI
 from messages import *
 
@@ -36,12 +43,24 @@ from messages import *
 TRACK_INTERVAL = 60
 WATCH_INTERVAL = 5
 INACTIVE_TIME = float(6 * iss.HOUR)
+WEBHOOK_URL = getattr(config, "WEBHOOK_URL", "")
+WEBHOOK_PORT = getattr(config, "WEBHOOK_PORT", 8443)
+FLUSH_INTERVAL = 30
+SEND_CONCURRENCY = 30  # Telegram allows about 30 messages per second
+
+# Job store used by earlier versions, which kept one job per subscribed
+# chat, named by prefix and chat id, e.g. track_1234
+LEGACY_JOBS_DATABASE = "apscheduler"
+LEGACY_JOBS_COLLECTION = "jobs"
+LEGACY_JOB_FIELDS = {"track": "gap", "watch": "callsign"}
+LEGACY_JOB_CALLBACKS = ("warn", "watch")
 
 
 # Enable logging
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
+logger = logging.getLogger(__name__)
 
 
 # Command handlers
@@ -63,7 +82,7 @@ async def why(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def send_last_heard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sends information about the latest APRS packet from the ISS."""
-    await update.message.reply_markdown_v2(iss.inform_last_heard())
+    await update.message.reply_markdown_v2(await iss.inform_last_heard(iss.WATCH_MAX_AGE))
 
 
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -72,109 +91,189 @@ async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 # Job handlers
-def remove_job_if_exists(name: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    """Remove job with given name. Returns whether job was removed."""
-    current_jobs = context.job_queue.get_jobs_by_name(name)
-    if not current_jobs:
+_send_semaphore = asyncio.Semaphore(SEND_CONCURRENCY)
+_chat_locks: defaultdict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+
+async def send_one(bot: ExtBot, chat_id: int, text: str) -> None:
+    """Send a MarkdownV2 message, waiting and retrying once if Telegram
+    asks us to slow down. At most SEND_CONCURRENCY sends run at once,
+    and sends to the same chat keep their order."""
+    async with _chat_locks[chat_id], _send_semaphore:
+        try:
+            await bot.send_message(chat_id, text, parse_mode="MarkdownV2")
+        except RetryAfter as error:
+            await asyncio.sleep(error.retry_after)
+            await bot.send_message(chat_id, text, parse_mode="MarkdownV2")
+
+
+async def send_all(bot: ExtBot, messages: list[tuple[int, str]]) -> None:
+    """Send messages to their chats concurrently. A failed send is
+    logged without affecting the others. Locks of chats with no send in
+    progress are dropped afterwards, so they do not pile up."""
+    results = await asyncio.gather(*(send_one(bot, chat_id, text)
+                                     for chat_id, text in messages),
+                                   return_exceptions=True)
+
+    for (chat_id, _), result in zip(messages, results):
+        if isinstance(result, Exception):
+            logger.warning("Could not notify chat %s: %s", chat_id, result)
+
+        # Forget the chat's lock unless another send is using it
+        lock = _chat_locks.get(chat_id)
+        if lock is not None and not lock.locked():
+            del _chat_locks[chat_id]
+
+
+# Subscriptions: kept in bot_data and saved to the subscriptions
+# collection, one document per kind (k) and chat id (c), holding the
+# subscription (d)
+def load_subscriptions(kind: str) -> dict[int, dict]:
+    """Returns the chats subscribed to tracking or watching, keyed by
+    chat id."""
+    subscriptions = iss.get_database().subscriptions
+    subscriptions.create_index([("k", ASCENDING), ("c", ASCENDING)], unique=True)
+
+    return {entry["c"]: entry["d"]
+            for entry in subscriptions.find({"k": kind}, {"_id": 0})}
+
+
+def save_subscription(kind: str, chat_id: int, subscription: dict) -> None:
+    """Saves a chat's subscription to tracking or watching."""
+    iss.get_database().subscriptions.update_one({"k": kind, "c": chat_id},
+                                                {"$set": {"d": subscription}},
+                                                upsert=True)
+
+
+def delete_subscription(kind: str, chat_id: int) -> None:
+    """Deletes a chat's subscription to tracking or watching."""
+    iss.get_database().subscriptions.delete_one({"k": kind, "c": chat_id})
+
+
+def get_subscribers(context: ContextTypes.DEFAULT_TYPE, kind: str) -> dict:
+    """Returns the chats subscribed to tracking or watching, keyed by
+    chat id."""
+    return context.bot_data.setdefault(kind + "_subs", {})
+
+
+async def subscribe(context: ContextTypes.DEFAULT_TYPE, kind: str,
+                    chat_id: int, subscription: dict) -> None:
+    """Subscribe a chat to tracking or watching and save it to the
+    database."""
+    get_subscribers(context, kind)[chat_id] = subscription
+    await asyncio.to_thread(save_subscription, kind, chat_id, subscription)
+
+
+async def unsubscribe(context: ContextTypes.DEFAULT_TYPE, kind: str,
+                      chat_id: int) -> bool:
+    """Unsubscribe a chat from tracking or watching. Returns whether
+    the chat was subscribed."""
+    if get_subscribers(context, kind).pop(chat_id, None) is None:
         return False
-    for job in current_jobs:
-        job.schedule_removal()
+
+    await asyncio.to_thread(delete_subscription, kind, chat_id)
     return True
 
 
 # Tracking: update user when new activity is heard
-async def warn(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Send an update if there is new APRS activity from the ISS after
-    a given gap of inactivity. The default is given by INACTIVE_TIME."""
-    job = context.job
-    inactivity_gap = job.data
+async def tick_track(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Scrape ariss.net once and send an update to every tracking chat
+    for which there is new APRS activity from the ISS after its gap of
+    inactivity. The default gap is given by INACTIVE_TIME."""
+    subscribers = get_subscribers(context, "track")
+    if not subscribers:
+        return
 
-    if iss.check_activity(str(job.user_id), inactivity_gap):
-        text = NEW_ACTIVITY
-        text += iss.inform_last_heard()
+    current_station = await iss.get_last_heard(iss.TRACK_MAX_AGE)
+    chats = [chat_id for chat_id, sub in list(subscribers.items())
+             if await iss.check_activity(str(sub["user_id"]),
+                                         sub["gap"],
+                                         current_station)]
+    if not chats:
+        return
 
-        await context.bot.send_message(job.chat_id,
-                                       text,
-                                       parse_mode="MarkdownV2")
+    text = NEW_ACTIVITY
+    text += await iss.inform_last_heard(iss.TRACK_MAX_AGE)
+
+    await send_all(context.bot, [(chat_id, text) for chat_id in chats])
 
 
 async def set_tracking(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Add a tracking job to the queue."""
+    """Subscribe the chat to tracking."""
     chat_id = update.effective_message.chat_id
     user_id = update.message.from_user.id
-    job_name = "track_" + str(chat_id)
     inactivity_gap =  float(context.args[0]) if context.args else INACTIVE_TIME
-    current_jobs = context.job_queue.get_jobs_by_name(job_name)
+    subscribers = get_subscribers(context, "track")
 
-    if current_jobs:
+    if chat_id in subscribers:
         await update.effective_message.reply_text(ALREADY_TRACK_MSG)
         return
 
-    context.job_queue.run_repeating(warn,
-                                    TRACK_INTERVAL,
-                                    chat_id=chat_id,
-                                    user_id=user_id,
-                                    name=job_name,
-                                    data=inactivity_gap)
+    await subscribe(context, "track", chat_id,
+                    {"user_id": user_id, "gap": inactivity_gap})
 
-    text = SUCCESS_TRACK_MSG + iss.inform_last_heard()
+    text = SUCCESS_TRACK_MSG + await iss.inform_last_heard(iss.WATCH_MAX_AGE)
     await update.effective_message.reply_markdown_v2(text)
 
 
 async def unset_tracking(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Remove a job from the queue and deletes user database."""
+    """Unsubscribe the chat from tracking and deletes user database."""
     chat_id = update.message.chat_id
     user_id = update.message.from_user.id
-    job_name = "track_" + str(chat_id)
-    job_removed = remove_job_if_exists(job_name, context)
-    text = UNSET_MSG if job_removed else UNSET_ERROR_MSG
+    removed = await unsubscribe(context, "track", chat_id)
+    text = UNSET_MSG if removed else UNSET_ERROR_MSG
 
-    if job_removed:
-        iss.delete_user_db(str(user_id), "track")
+    if removed:
+        await iss.delete_user_db(str(user_id), "track")
 
     await update.message.reply_text(text)
 
 
 # Watching: listen for activity from a given callsign
-async def watch(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Send an update if there is new activity from a specific callsign."""
-    job = context.job
-    callsign = job.data
+async def tick_watch(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Scrape ariss.net once and send an update to every chat watching
+    the callsign that was just heard."""
+    subscribers = get_subscribers(context, "watch")
+    if not subscribers:
+        return
+
+    current_station = await iss.get_last_heard(iss.WATCH_MAX_AGE)
+    messages = []
 
-    if iss.was_callsign_heard(str(job.user_id), callsign):
-        text = NEW_ACTIVITY
-        text += "*" + callsign.replace("-", "\\-") + "*"
-        text += CALLSIGN_ACTIVITY
+    for chat_id, sub in list(subscribers.items()):
+        callsign = sub["callsign"]
 
-        await context.bot.send_message(job.chat_id,
-                                       text,
-                                       parse_mode="MarkdownV2")
+        if await iss.was_callsign_heard(str(sub["user_id"]),
+                                        callsign,
+                                        current_station):
+            text = NEW_ACTIVITY
+            text += "*" + iss.escape_markdown(callsign) + "*"
+            text += CALLSIGN_ACTIVITY
+
+            messages.append((chat_id, text))
+
+    await send_all(context.bot, messages)
 
 
 async def set_watching(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Add a watching job to the queue."""
+    """Subscribe the chat to watching a callsign."""
     chat_id = update.effective_message.chat_id
     user_id = update.message.from_user.id
-    job_name = "watch_" + str(chat_id)
-    current_jobs = context.job_queue.get_jobs_by_name(job_name)
+    subscribers = get_subscribers(context, "watch")
 
     try:
         callsign = context.args[0]
         callsign = callsign.upper()
 
-        if current_jobs:
+        if chat_id in subscribers:
             await update.effective_message.reply_text(ALREADY_WATCH_MSG)
             return
 
-        context.job_queue.run_repeating(watch,
-                                        WATCH_INTERVAL,
-                                        chat_id=chat_id,
-                                        user_id=user_id,
-                                        name=job_name,
-                                        data=callsign)
+        await subscribe(context, "watch", chat_id,
+                        {"user_id": user_id, "callsign": callsign})
 
         text = SUCCESS_WATCH_MSG
-        text += "*" + callsign.replace("-", "\\-") + "*\\. "
+        text += "*" + iss.escape_markdown(callsign) + "*\\. "
         text += STOP_WATCH_MSG
         await update.effective_message.reply_markdown_v2(text)
 
@@ -183,28 +282,99 @@ async def set_watching(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 
 async def unset_watching(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Remove a watch job from the queue."""
+    """Unsubscribe the chat from watching a callsign."""
     chat_id = update.message.chat_id
     user_id = update.message.from_user.id
-    job_name = "watch_" + str(chat_id)
-    job_removed = remove_job_if_exists(job_name, context)
-    text = UNSET_WATCH_MSG if job_removed else UNSET_WATCH_ERROR_MSG
+    removed = await unsubscribe(context, "watch", chat_id)
+    text = UNSET_WATCH_MSG if removed else UNSET_WATCH_ERROR_MSG
 
-    if job_removed:
-        iss.delete_user_db(str(user_id), "watch")
+    if removed:
+        await iss.delete_user_db(str(user_id), "watch")
 
     await update.message.reply_text(text)
 
 
+# Database: write changed user state in batches
+async def flush_state(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Write the user state changed since the last flush."""
+    await iss.flush_state()
+
+
+# Migration: subscriptions kept as jobs by earlier versions
+class LegacyJobUnpickler(pickle.Unpickler):
+    """Unpickles jobs saved by earlier versions, whose callbacks no
+    longer exist."""
+
+    def find_class(self, module: str, name: str) -> object:
+        if module in ("__main__", "bot") and name in LEGACY_JOB_CALLBACKS:
+            return None
+        return super().find_class(module, name)
+
+
+def import_legacy_jobs() -> None:
+    """Moves the per-chat tracking and watching jobs saved by earlier
+    versions into the subscriptions collection and deletes them from
+    the job store. A chat that already has a subscription keeps it."""
+    database = iss.get_database()
+    jobs = database.client[LEGACY_JOBS_DATABASE][LEGACY_JOBS_COLLECTION]
+
+    for document in jobs.find({}, ["_id", "job_state"]):
+        try:
+            job_state = LegacyJobUnpickler(io.BytesIO(document["job_state"])).load()
+            name, data, chat_id, user_id = job_state["args"][:4]
+        except Exception as error:
+            logger.warning("Could not read job %s: %s", document["_id"], error)
+            continue
+
+        kind, _, _ = str(name).partition("_")
+        if kind not in LEGACY_JOB_FIELDS:
+            continue
+
+        logger.info("Importing legacy %s job for chat %s", kind, chat_id)
+        database.subscriptions.update_one(
+            {"k": kind, "c": chat_id},
+            {"$setOnInsert": {"d": {"user_id": user_id,
+                                    LEGACY_JOB_FIELDS[kind]: data}}},
+            upsert=True)
+        jobs.delete_one({"_id": document["_id"]})
+
+
+# Application lifecycle
+async def post_init(app: Application) -> None:
+    """Loads subscriptions and the users' state, imports and archives
+    subscriptions and state left by older versions and opens the HTTP
+    client used to scrape ariss.net. Runs before the job queue starts,
+    so legacy jobs are imported before the job store would drop them."""
+    await asyncio.to_thread(import_legacy_jobs)
+
+    for kind in ("track", "watch"):
+        app.bot_data[kind + "_subs"] = await asyncio.to_thread(
+            load_subscriptions, kind)
+
+    await asyncio.to_thread(iss.load_state)
+    await asyncio.to_thread(iss.import_legacy_db)
+    await iss.flush_state()
+    await asyncio.to_thread(iss.retire_legacy_db)
+    await iss.open_session()
+
+
+async def post_shutdown(app: Application) -> None:
+    """Writes pending user state and closes the HTTP client used to
+    scrape ariss.net."""
+    await iss.flush_state()
+    await iss.close_session()
+
+
 # Main loop
 def main() -> None:
     """Run bot."""
 
-    # Setup bot and persistence
-    persistence = PicklePersistence(filepath="iss_aprs_bot_persistence")
+    # Setup bot. Subscriptions and user state are kept in MongoDB, so
+    # no PTB persistence is needed
     app = (Application.builder()
            .token(BOT_KEY)
-           .persistence(persistence=persistence)
+           .post_init(post_init)
+           .post_shutdown(post_shutdown)
            .build()
            )
 
@@ -215,6 +385,23 @@ def main() -> None:
         )
     )
 
+    # Shared jobs, replacing the copies restored from the job store
+    app.job_queue.run_repeating(tick_track,
+                                TRACK_INTERVAL,
+                                name="tick_track",
+                                job_kwargs={"id": "tick_track",
+                                            "replace_existing": True})
+    app.job_queue.run_repeating(tick_watch,
+                                WATCH_INTERVAL,
+                                name="tick_watch",
+                                job_kwargs={"id": "tick_watch",
+                                            "replace_existing": True})
+    app.job_queue.run_repeating(flush_state,
+                                FLUSH_INTERVAL,
+                                name="flush_state",
+                                job_kwargs={"id": "flush_state",
+                                            "replace_existing": True})
+
     # Command handlers
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", helpme))
@@ -226,8 +413,16 @@ def main() -> None:
     app.add_handler(CommandHandler("unwatch", unset_watching))
     app.add_handler(MessageHandler(filters.COMMAND, unknown))
 
-    # Run the bot until the user presses Ctrl-C
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Run the bot until the user presses Ctrl-C. Telegram pushes updates
+    # to the webhook if one is configured; otherwise, fall back to polling
+    if WEBHOOK_URL:
+        app.run_webhook(listen="0.0.0.0",
+                        port=WEBHOOK_PORT,
+                        url_path=BOT_KEY,
+                        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{BOT_KEY}",
+                        allowed_updates=Update.ALL_TYPES)
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
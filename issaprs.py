@@ -22,18 +22,33 @@ Automatically scrapes http://ariss.net to detect new APRS activity
 from the ISS.
 """
 
+import asyncio
 import csv
+import functools
+import gzip
+import html
+import itertools
 import os
+import re
+import shutil
 import time
-import threading
 from datetime import datetime, timezone
 
-import requests
-from bs4 import BeautifulSoup
+import httpx
+from pymongo import ASCENDING, DeleteOne, MongoClient, UpdateOne
+from pymongo.database import Database
+
+from config import MONGO_DB_URI
 
 # ARISS last stations heard via ISS page
 PAGE = "http://ariss.net?absolute=1"
 
+# HTTP client options
+USER_AGENT = "iss-aprs-bot/1.0"
+ACCEPT_ENCODING = "br, gzip"
+TIMEOUT = 10
+MAX_CONNECTIONS = 4
+
 # Minute, hour and day in seconds:
 SECOND = 1
 MINUTE = SECOND * 60
@@ -44,34 +59,185 @@ DAY = HOUR * 24
 INTERVAL = 5 * SECOND
 INACTIVE_TIME = float(5 * SECOND)
 
+# Maximum age of a cached scrape before ariss.net is fetched again
+TRACK_MAX_AGE = 30 * SECOND
+WATCH_MAX_AGE = 3 * SECOND
+
+# Patterns used to parse the ariss.net table
+_ROW_RE = re.compile(r'<tr[\s>].*?(?=<tr[\s>]|</table|\Z)', re.S | re.I)
+_CELL_RE = re.compile(r'<td[^>]*>(.*?)</td>', re.S | re.I)
+_HREF_RE = re.compile(r'<a\s[^>]*?href\s*=\s*["\']?([^"\'\s>]*)', re.I)
+_TAG_RE = re.compile(r'<[^>]*>')
+
+# Units used to print elapsed time: upper limit, name, and length.
+# Anything longer is printed in days
+_TIME_UNITS = ((MINUTE, "second", SECOND),
+               (HOUR, "minute", MINUTE),
+               (DAY, "hour", HOUR))
+
+# Telegram MarkdownV2 escaping, for text and for link URLs
+_MDV2_ESCAPE = str.maketrans({c: "\\" + c for c in "\\_*[]()~`>#+-=|{}.!"})
+_MDV2_LINK_ESCAPE = str.maketrans({c: "\\" + c for c in "\\)"})
+
 # Database options
 NO_USER = 'testing'
-DB_DIR = 'db/'
+MONGO_MAX_POOL_SIZE = 20
+MONGO_MIN_POOL_SIZE = 2
+LEGACY_DB_DIR = 'db/'
+
+
+# Last scrape shared by every user, so that they all hit ariss.net once
+_last_heard: list[str] | None = None
+_last_heard_ts: float = 0.0
+_last_heard_lock = asyncio.Lock()
+
+# Validators from the last parsed ariss.net response, for conditional
+# requests
+_last_etag: str | None = None
+_last_modified: str | None = None
+
+# MongoDB client, connected on first use by get_database. The database
+# holds two collections:
+# - state: last station seen by each user, one document per user (u)
+#   and database type (t), holding the station (s)
+# - subscriptions: chats subscribed to tracking or watching, managed
+#   by bot.py
+_mongo: MongoClient | None = None
+
+# In-memory copy of the database, so that checks do not touch it.
+# Filled by load_state
+_state: dict[tuple[str, str], tuple[str, str, str]] = {}
+
+# Entries of _state changed since they were last written to the database
+_dirty: set[tuple[str, str]] = set()
+
+# Entries removed from _state since the last flush, to be deleted from
+# the database by it. Flushes run one at a time, so that a deletion is
+# never overtaken by an older write of the same entry
+_deleted: set[tuple[str, str]] = set()
+_flush_lock = asyncio.Lock()
+
+# HTTP client kept open while the bot runs
+_session: httpx.AsyncClient | None = None
+
+
+# HTTP session functions
+def new_client() -> httpx.AsyncClient:
+    """Returns an HTTP client that keeps connections to ariss.net
+    alive between requests and asks for compressed responses."""
+    return httpx.AsyncClient(headers={"User-Agent": USER_AGENT,
+                                      "Accept-Encoding": ACCEPT_ENCODING},
+                             timeout=TIMEOUT,
+                             follow_redirects=True,
+                             limits=httpx.Limits(
+                                 max_connections=MAX_CONNECTIONS,
+                                 max_keepalive_connections=MAX_CONNECTIONS))
+
+
+async def open_session() -> None:
+    """Opens the HTTP client reused by every scrape."""
+    global _session
+    if _session is None:
+        _session = new_client()
+
+
+async def close_session() -> None:
+    """Closes the HTTP client opened by open_session."""
+    global _session
+    if _session is not None:
+        await _session.aclose()
+        _session = None
+
+
+async def fetch_page(conditional: bool = False) -> httpx.Response | None:
+    """Downloads the ariss.net page. Uses the shared HTTP client if it
+    is open, or a one-off client otherwise. If conditional is set,
+    returns None when the page has not changed since the last parsed
+    fetch."""
+    headers = {}
+
+    if conditional and _last_etag:
+        headers["If-None-Match"] = _last_etag
+    if conditional and _last_modified:
+        headers["If-Modified-Since"] = _last_modified
+
+    if _session is not None:
+        response = await _session.get(PAGE, headers=headers)
+    else:
+        async with new_client() as client:
+            response = await client.get(PAGE, headers=headers)
+
+    if response.status_code == httpx.codes.NOT_MODIFIED:
+        return None
+
+    response.raise_for_status()
+
+    return response
 
 
 # Scrapping functions
-def get_last_heard() -> list[str]:
-    """Scrapes latest APRS activity heard from the ISS. Returns the
+async def get_last_heard(max_age: float = 0) -> list[str]:
+    """Returns the last station heard, scraping ariss.net only if the
+    cached scrape is older than max_age seconds. The page is only
+    parsed again if ariss.net reports it has changed, and its
+    validators are only kept once it has been parsed."""
+    global _last_heard, _last_heard_ts, _last_etag, _last_modified
+
+    async with _last_heard_lock:
+        last_heard = _last_heard
+        age = time.monotonic() - _last_heard_ts
+        if last_heard is None or age >= max_age:
+            response = await fetch_page(conditional=last_heard is not None)
+            if response is not None:
+                last_heard = parse_last_heard(response.text)
+                _last_etag = response.headers.get("ETag")
+                _last_modified = response.headers.get("Last-Modified")
+            if last_heard is None:
+                raise ValueError("ariss.net reported no change before any page was parsed")
+            _last_heard = last_heard
+            _last_heard_ts = time.monotonic()
+
+        return list(last_heard)
+
+
+def parse_last_heard(page: str) -> list[str]:
+    """Parses latest APRS activity heard from the ISS. Returns the
     last station heard as an array with strings representing the
-    callsign, time, and findU.com URL."""
-    soup = BeautifulSoup(requests.get(PAGE).text, 'html.parser')
-    rows = soup.find_all('tr')
-    last_heard = rows[1].find_all('td')
-    callsign = last_heard[0].text.strip()
-    timestamp = last_heard[4].text.strip()
+    callsign, time, and findU.com URL. Raises ValueError if the page
+    has no such station."""
+    rows = [row.group() for row in itertools.islice(_ROW_RE.finditer(page), 2)]
+    last_heard = _CELL_RE.findall(rows[1]) if len(rows) == 2 else []
 
-    try:
-        link = last_heard[0].find('a').get('href')
-    except AttributeError:
-        link = ''
+    if len(last_heard) < 5:
+        raise ValueError("ariss.net page has no last heard station")
+
+    callsign = cell_text(last_heard[0])
+    timestamp = cell_text(last_heard[4])
+    href = _HREF_RE.search(last_heard[0])
+    link = html.unescape(href.group(1)) if href else ''
 
     return [callsign, timestamp, link]
 
 
+def cell_text(cell: str) -> str:
+    """Returns the text inside a table cell, without markup."""
+    return html.unescape(_TAG_RE.sub('', cell)).strip()
+
+
+@functools.lru_cache(maxsize=64)
+def parse_timestamp(timestamp: str) -> datetime:
+    """Parses time in the format year, month, day, hour, minutes, and
+    seconds, as used by ariss.net, into a UTC datetime."""
+    return datetime(int(timestamp[0:4]), int(timestamp[4:6]),
+                    int(timestamp[6:8]), int(timestamp[8:10]),
+                    int(timestamp[10:12]), int(timestamp[12:14]),
+                    tzinfo=timezone.utc)
+
+
 def calculate_elapsed_time(timestamp: str) -> float:
     """Parses time in the format year, month, day, hour, minutes, and
     seconds, and returns a float of how many seconds have passed."""
-    parsed_time = datetime.strptime(timestamp, "%Y%m%d%H%M%S").replace(tzinfo=timezone.utc)
+    parsed_time = parse_timestamp(timestamp)
     current_time = datetime.now(timezone.utc)
     time_delta = current_time - parsed_time
     return time_delta.total_seconds()
@@ -80,120 +246,181 @@ def calculate_elapsed_time(timestamp: str) -> float:
 def print_elapsed_time(delta_in_sec: float) -> str:
     """Returns a string of how much time has elapsed since an event,
     e.g., "1 second ago", "10 minutes ago", "8 days ago"."""
+    for limit, unit, length in _TIME_UNITS:
+        if delta_in_sec < limit:
+            break
+    else:
+        unit, length = "day", DAY
+
+    amount = max(1, round(delta_in_sec / length))
+    return f"{amount} {unit}" + ("s" if amount != 1 else "")
+
 
-    # Parse seconds
-    if delta_in_sec == SECOND:
-        return "1 second"
-    if delta_in_sec < MINUTE:
-        return f"{round(delta_in_sec)} seconds"
-
-    # Parse minutes
-    if delta_in_sec < HOUR:
-        delta_in_min = round(delta_in_sec / MINUTE)
-        if delta_in_min == 1:
-            return "1 minute"
-        if delta_in_min > 1:
-            return f"{delta_in_min} minutes"
-
-    # Parse hours
-    if delta_in_sec < DAY:
-        delta_in_hour = round(delta_in_sec / HOUR)
-        if delta_in_hour == 1:
-            return "1 hour"
-        if delta_in_hour > 1:
-            return f"{delta_in_hour} hours"
-
-    # Parse days
-    if delta_in_sec > DAY:
-        delta_in_day = round(delta_in_sec / DAY)
-        if delta_in_day == 1:
-            return "1 day"
-        if delta_in_day > 1:
-            return f"{delta_in_day} days"
-
-
-def inform_last_heard() -> str:
+def escape_markdown(text: str) -> str:
+    """Escapes text to be sent with Telegram's MarkdownV2."""
+    return text.translate(_MDV2_ESCAPE)
+
+
+async def inform_last_heard(max_age: float = 0) -> str:
     """Returns a string informing what station was last heard by the
     ISS on APRS and how long ago that was. The string includes a
     Markdown-style link to findu.com."""
-    last_heard = get_last_heard()
+    last_heard = await get_last_heard(max_age)
     callsign = last_heard[0]
     timestamp = last_heard[1]
     elapsed_time = calculate_elapsed_time(timestamp)
-    link = last_heard[2]
+    link = last_heard[2].translate(_MDV2_LINK_ESCAPE)
 
-    output = f"The last station heard was *{callsign}, "
-    output += f"{print_elapsed_time(elapsed_time)} ago*. "
-    output += f"See details at [findu.com]({link})." if link else ""
-    output = output.replace("-", "\\-").replace(".", "\\.")
+    output = f"The last station heard was *{escape_markdown(callsign)}, "
+    output += f"{escape_markdown(print_elapsed_time(elapsed_time))} ago*\\. "
+    output += f"See details at [findu\\.com]({link})\\." if link else ""
 
     return output
 
 
 # Database functions
-def is_entry_in_db(db_path: str, entry: list) -> bool:
-    """Returns if the latest entry in the database is the same as the
-    current entry."""
-    if not os.path.isfile(db_path):
-        return False
+def get_database() -> Database:
+    """Returns the bot's MongoDB database, connecting on first use."""
+    global _mongo
+    if _mongo is None:
+        _mongo = MongoClient(MONGO_DB_URI,
+                             maxPoolSize=MONGO_MAX_POOL_SIZE,
+                             minPoolSize=MONGO_MIN_POOL_SIZE)
+
+    return _mongo.iss
+
+
+def load_state() -> None:
+    """Indexes the database and loads every user's last heard station
+    into memory."""
+    states = get_database().state
+    states.create_index([("u", ASCENDING), ("t", ASCENDING)], unique=True)
+
+    for entry in states.find({}, {"_id": 0, "u": 1, "t": 1, "s": 1}):
+        _state[(entry["u"], entry["t"])] = tuple(entry["s"])
+
+
+async def flush_state() -> None:
+    """Writes every station changed or deleted since the last flush to
+    the database in a single batch."""
+    async with _flush_lock:
+        if not _dirty and not _deleted:
+            return
+
+        keys = list(_dirty)
+        deleted = list(_deleted)
+        _dirty.clear()
+        _deleted.clear()
+        operations = [UpdateOne({"u": user, "t": db_type},
+                                {"$set": {"s": list(_state[(user, db_type)])}},
+                                upsert=True)
+                      for user, db_type in keys]
+        operations += [DeleteOne({"u": user, "t": db_type})
+                       for user, db_type in deleted]
+
+        try:
+            await asyncio.to_thread(get_database().state.bulk_write,
+                                    operations,
+                                    ordered=False)
+        except Exception:
+            _dirty.update(key for key in keys if key in _state)
+            _deleted.update(key for key in deleted if key not in _state)
+            raise
+
+
+def save_last_heard(user: str, db_type: str, current: list) -> None:
+    """Saves the current last heard station in memory and, if it has
+    changed, marks it to be written by the next flush_state."""
+    callsign, timestamp, link = current
+    station = (callsign, timestamp, link)
+
+    if _state.get((user, db_type)) != station:
+        _state[(user, db_type)] = station
+        _dirty.add((user, db_type))
+        _deleted.discard((user, db_type))
+
+
+def read_previously_heard(user: str, db_type: str) -> list[str]:
+    """Returns the previously last heard station. If nothing was
+    found, returns an empty list."""
+    return list(_state.get((user, db_type), ()))
 
-    with open(db_path, 'r', encoding = 'UTF-8') as csvfile:
-        reader = csv.reader(csvfile)
-        last_line = None
 
-        for row in reader:
-            last_line = row
-        return last_line == entry
+def user_has_db(user: str, db_type : str) -> bool:
+    """Checks if user has an entry in the database."""
+    return (user, db_type) in _state
+
+
+def create_db_for_user(user: str, current: list, db_type: str) -> None:
+    "Initializes the user's database with the current station."
+    print(f"Log: Initializing ISS APRS database for {user}.")
+    save_last_heard(user, db_type, current)
+
 
+async def delete_user_db(user: str, db_type: str) -> None:
+    """Given a user, delete its database entry."""
+    if user_has_db(user, db_type):
+        print(f"Deleting user {user} database…")
+        del _state[(user, db_type)]
+        _dirty.discard((user, db_type))
+        _deleted.add((user, db_type))
+        await flush_state()
 
-def save_last_heard(db_path: str, current: list) -> None:
-    """Saves the current last heard station in the database."""
-    if not is_entry_in_db(db_path, current):
-        with open(db_path, 'a', encoding = 'UTF-8', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(current)
 
+def read_last_csv_row(path: str) -> list[str]:
+    """Returns the last row of a CSV file, reading only the end of the
+    file. If nothing was found, returns an empty list."""
+    size = os.stat(path).st_size
 
-def read_previously_heard(db_path: str) -> list[str]:
-    """Returns the previously last heard station from the database. If
-    nothing was found, returns an empty list."""
-    with open(db_path, 'r',  encoding = 'UTF-8',) as csvfile:
-        reader = csv.reader(csvfile)
-        last_line = []
+    with open(path, 'rb') as csvfile:
+        csvfile.seek(-min(4096, size), os.SEEK_END)
+        lines = csvfile.read().decode('UTF-8', errors='replace').splitlines()
 
-        for row in reader:
-            last_line = row
-        return last_line
+    for line in reversed(lines):
+        if line.strip():
+            return next(csv.reader([line]))
 
+    return []
 
-def user_db_path(user: str, db_type: str) -> str:
-    """Returns the path to a user's database."""
-    user_db = DB_DIR + user + "-" + db_type + '.csv'
 
-    return user_db
+def import_legacy_db() -> None:
+    """Imports the last station of every user from the per-user CSV
+    files used by earlier versions, unless the user already has an
+    entry in the database."""
+    if not os.path.isdir(LEGACY_DB_DIR):
+        return
 
+    for filename in os.listdir(LEGACY_DB_DIR):
+        if not filename.endswith('.csv'):
+            continue
 
-def user_has_db(user: str, db_type : str) -> bool:
-    """Checks if user has a database file."""
-    user_db = user_db_path(user, db_type)
+        user, _, db_type = filename[:-len('.csv')].rpartition("-")
+        if not user or (user, db_type) in _state:
+            continue
 
-    return os.path.isfile(user_db)
+        row = read_last_csv_row(os.path.join(LEGACY_DB_DIR, filename))
+        if len(row) == 3:
+            print(f"Log: Importing legacy ISS APRS database for {user}.")
+            save_last_heard(user, db_type, row)
 
 
-def create_db_for_user(user: str, current: list, db_type: str) -> None:
-    "Initializes the user's database with the current station."
-    user_db = user_db_path(user, db_type)
+def retire_legacy_db() -> None:
+    """Compresses the per-user CSV files used by earlier versions and
+    removes the originals, so that they are neither read nor grown
+    again. Meant to run once import_legacy_db has been flushed."""
+    if not os.path.isdir(LEGACY_DB_DIR):
+        return
 
-    print(f"Log: Initializing ISS APRS database for {user}.")
-    save_last_heard(user_db, current)
+    for filename in os.listdir(LEGACY_DB_DIR):
+        if not filename.endswith('.csv'):
+            continue
 
+        path = os.path.join(LEGACY_DB_DIR, filename)
+        with open(path, 'rb') as csvfile, gzip.open(path + '.gz', 'wb') as gzfile:
+            shutil.copyfileobj(csvfile, gzfile)
 
-def delete_user_db(user: str, db_type: str) -> None:
-    """Given a user, delete its database file."""
-    if user_has_db(user, db_type):
-        user_db = user_db_path(user, db_type)
-        print(f"Deleting user {user} database…")
-        os.remove(user_db)
+        print(f"Log: Archived legacy ISS APRS database {path}.gz")
+        os.remove(path)
 
 
 # Activity checking and reporting
@@ -210,72 +437,78 @@ def new_activity(previous: list, current: list, threshold: float) -> bool:
 
 
 # Tracking
-def check_activity(user: str, threshold: float) -> bool:
+async def check_activity(user: str, threshold: float, current_station: list) -> bool:
     """Returns whether new APRS activity from the ISS has been
-    detected."""
+    detected, given the current last heard station."""
     print(f"{datetime.now()}: Checking…")
 
     db_type = "track"
-    user_db = user_db_path(user, db_type)
-    current_station = get_last_heard()
 
     if not user_has_db(user, db_type):
         create_db_for_user(user, current_station, db_type)
 
-    previous_station = read_previously_heard(user_db)
+    previous_station = read_previously_heard(user, db_type)
 
     if new_activity(previous_station, current_station, threshold):
         print(f"{datetime.now()}: New ISS APRS activity!")
-        print(inform_last_heard())
-        save_last_heard(user_db, current_station)
+        print(await inform_last_heard(TRACK_MAX_AGE))
+        save_last_heard(user, db_type, current_station)
 
         return True
 
     print(f"{datetime.now()}: Nothing new…")
-    save_last_heard(user_db, current_station)
+    save_last_heard(user, db_type, current_station)
 
     return False
 
 
 # Watching
-def was_callsign_heard(user: str, callsign: str) -> bool:
-    """Returns whether a callsign's packet was digipeated by the
-    ISS."""
+async def was_callsign_heard(user: str, callsign: str, current_station: list) -> bool:
+    """Returns whether a callsign's packet was digipeated by the ISS,
+    given the current last heard station."""
     db_type = "watch"
-    user_db = user_db_path(user, db_type)
-    current_station = get_last_heard()
     current_callsign = current_station[0]
     threshold = SECOND
 
     if not user_has_db(user, db_type):
         create_db_for_user(user, current_station, db_type)
 
-    previous_station = read_previously_heard(user_db)
+    previous_station = read_previously_heard(user, db_type)
 
     if new_activity(previous_station, current_station, threshold):
         if current_callsign == callsign:
-            save_last_heard(user_db, current_station)
+            save_last_heard(user, db_type, current_station)
 
             return True
 
-    save_last_heard(user_db, current_station)
+    save_last_heard(user, db_type, current_station)
     return False
 
 
 # Functionality testing
-def periodically_check_activity() -> None:
+async def periodically_check_activity() -> None:
     """Runs the tracking routine indefinitely. Useful in testing."""
-    while True:
-        check_activity(NO_USER, INACTIVE_TIME)
-        time.sleep(INTERVAL)
+    await open_session()
+
+    try:
+        print(await inform_last_heard())
+
+        while True:
+            current_station = await get_last_heard(TRACK_MAX_AGE)
+            await check_activity(NO_USER, INACTIVE_TIME, current_station)
+            await asyncio.sleep(INTERVAL)
+    finally:
+        await flush_state()
+        await close_session()
 
 
 def main() -> None:
-    print(inform_last_heard())
+    load_state()
 
-    thread = threading.Thread(target=periodically_check_activity)
-    # thread.daemon = True
-    thread.start()
+    try:
+        asyncio.run(periodically_check_activity())
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":